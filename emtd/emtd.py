@@ -1,16 +1,24 @@
 import os
 import shutil
-import re
+import hashlib
+import pickle
 import logging
 from typing import Optional
 
 from pathlib import Path
 import subprocess
 import tempfile
+from collections import deque
 
 import yaml
 import pandas as pd
 
+try:
+    # Prefer the (much faster) libyaml bindings, if PyYAML was built with them.
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
 
 class EMTD:
     """
@@ -20,7 +28,9 @@ class EMTD:
     for given years.
 
     Methods:
-        EMTD(target_dir: Optional[str], params: Optional[dict], version: str): Initializes the EMTD object.
+        EMTD(target_dir: Optional[str], params: Optional[dict], version: str, shallow: bool, jobs: Optional[int],
+             scheduler: str):
+                Initializes the EMTD object.
 
         technologies(self, year: int):
                 Retrieves the unique technologies available for a given year.
@@ -55,7 +65,13 @@ class EMTD:
     """
 
     def __init__(
-        self, target_dir: Optional[str] = None, params: Optional[dict] = None, version: str = "latest"
+        self,
+        target_dir: Optional[str] = None,
+        params: Optional[dict] = None,
+        version: str = "latest",
+        shallow: bool = True,
+        jobs: Optional[int] = None,
+        scheduler: str = "greedy",
     ) -> None:
         """
         Initializes the EMTD object with an optional target directory and parameters.
@@ -66,12 +82,25 @@ class EMTD:
             version (str):
                 The data set version to use (e.g. "v0.6.2"); "latest" (the default) uses the most up-to-date version,
                 but may result in different data each time you call it. Consider fixing to a specific version!
+            shallow (bool):
+                Whether to only fetch the latest commit of the 'technology-data' repository (the default), instead of
+                its full history. Disable this if you need to inspect the history (e.g. using `git log`).
+            jobs (Optional[int]): The number of parallel jobs for snakemake; defaults to the number of CPU cores.
+            scheduler (str): The snakemake job scheduler, either "greedy" (the default) or "ilp".
         """
         self._logger = logging.getLogger("emtd")
-        self._results = dict()
+        self._available_years = set()
+        self._target_dir = None
+        self._cfg_hash = None
+        self._fn_results = None
+        self._categories = dict()
+        self._technologies = dict()
+        self._entries = dict()
         self._params = params or dict()
         self._config = dict()
         self._snakemake_output = None
+        self._jobs = jobs or os.cpu_count() or 1
+        self._scheduler = scheduler
 
         if version == "latest":
             self._logger.warning(
@@ -84,7 +113,7 @@ class EMTD:
                 "Temporary directories are not automatically deleted and can take up significant space"
             )
 
-        self._prepare(Path(target_dir or tempfile.TemporaryDirectory().name), version)
+        self._prepare(Path(target_dir or tempfile.TemporaryDirectory().name), version, shallow)
 
     def technologies(self, year: int) -> list:
         """
@@ -96,10 +125,10 @@ class EMTD:
         Returns:
             List[str]: A list of unique technology names,  or an empty list on error.
         """
-        if year not in self._results:
+        if year not in self._available_years:
             self._logger.error("No results for year %d", year)
             return list()
-        return list(self._results[year].technology.unique())
+        return list(self._cached_technologies(year))
 
     def parameters(self, year: int, tech: str) -> list:
         """
@@ -112,13 +141,10 @@ class EMTD:
         Returns:
             List[str]: A list of unique parameter names, or an empty list on error.
         """
-        if year not in self._results:
+        if year not in self._available_years:
             self._logger.error("No results for [year=%d, tech=%s]", year, tech)
             return list()
-
-        ret = self._results[year]
-        ret = ret.loc[ret.technology == tech]
-        return list(ret.parameter.unique())
+        return list(self._cached_parameters(year, tech))
 
     def get(self, year: int, tech: str, param: str) -> dict:
         """
@@ -133,22 +159,19 @@ class EMTD:
             dict: A dictionary containing the "value", "unit", "source", and "further description" of the parameter.
                   Returns an empty dict on error.
         """
-        if (tech not in self.technologies(year)) or (param not in self.parameters(year, tech)):
+        if year not in self._available_years:
             self._logger.error("No results for [year=%d, tech=%s, param=%s]", year, tech, param)
             return dict()
 
-        ret = self._results[year]
-        ret = ret.loc[
-            (ret.technology == tech) & (ret.parameter == param), ["value", "unit", "source", "further description"]
-        ]
-        if len(ret) == 0:
-            self._logger.error("Zero (0) results for [year=%d, tech=%s, param=%s]", year, tech, param)
-            return dict()
-        if len(ret) > 1:
+        entry = self._cached_entries(year).get((tech, param), dict())
+        if entry is None:
             self._logger.error("Ambiguous results for [year=%d, tech=%s, param=%s]", year, tech, param)
             return dict()
+        if not entry:
+            self._logger.error("No results for [year=%d, tech=%s, param=%s]", year, tech, param)
+            return dict()
 
-        return ret.iloc[0].to_dict()
+        return dict(entry)
 
     def config(self, prop: str):
         """
@@ -165,20 +188,20 @@ class EMTD:
             return None
         return self._config[prop]
 
-    def _prepare(self, target_dir: Path, version: str) -> None:
+    def _prepare(self, target_dir: Path, version: str, shallow: bool) -> None:
         self._logger.info("Using temporary directory '%s' to manage 'technology-data'", target_dir)
 
-        self._clone_repository("https://github.com/PyPSA/technology-data.git", target_dir, version)
+        self._clone_repository("https://github.com/PyPSA/technology-data.git", target_dir, version, shallow)
 
         fn_cfg = target_dir / "_emtd_config.yaml"
 
         with open(target_dir / "config.yaml", "r") as f:
-            self._config = yaml.safe_load(f)
+            self._config = yaml.load(f, Loader=SafeLoader)
             self._config.update(self._params)
 
         if fn_cfg.is_file():
             with open(fn_cfg, "r") as f:
-                last_cfg = yaml.safe_load(f)
+                last_cfg = yaml.load(f, Loader=SafeLoader)
                 if self._config == last_cfg:
                     self._logger.info("Config did not change, re-using existing data and outputs")
                 else:
@@ -197,59 +220,326 @@ class EMTD:
             shutil.rmtree(target_dir / "outputs")
 
         with open(fn_cfg, "w") as f:
-            yaml.dump(self._config, f)
+            yaml.dump(self._config, f, Dumper=SafeDumper)
+
+        # Skip snakemake altogether, if it already ran successfully on the same config and revision.
+        fn_hash = target_dir / "_emtd_cache_hash"
+        cfg_hash = self._config_hash(target_dir)
+        cache_hit = fn_hash.is_file() and fn_hash.read_text() == cfg_hash and self._has_outputs(target_dir)
+        if cache_hit:
+            self._logger.info("Found cached outputs for the current config; skipping snakemake workflow")
+        else:
+            fn_hash.unlink(missing_ok=True)
+            if self._run_snakemake(target_dir):
+                fn_hash.write_text(cfg_hash)
+
+        self._target_dir = target_dir
+        fn_results = target_dir / f"_emtd_results_{cfg_hash}.pkl"
+        results = self._load_results(fn_results) if cache_hit else None
+        if results is not None:
+            self._logger.info("Loaded previously parsed outputs of snakemake workflow")
+            self._entries = results
+            self._available_years = set(self._entries)
+        else:
+            self._available_years = set(self._list_results(target_dir, "costs"))
+
+            # Only persist results that belong to a successful snakemake run, replacing results of older configs.
+            for fn in target_dir.glob("_emtd_results_*.pkl"):
+                fn.unlink()
+            if fn_hash.is_file():
+                # Outputs are only parsed on first access (see `_cached_entries`), since often only some years are
+                # used; the hash allows detecting whether they changed in the meantime.
+                self._cfg_hash = cfg_hash
+                self._fn_results = fn_results
+            else:
+                # Without a successful snakemake run, later changes can not be detected; parse everything right away.
+                for year in self._available_years:
+                    self._cached_entries(year)
 
-        self._run_snakemake(target_dir)
+    def _clone_repository(self, repo_url: str, target_dir: Path, version: str, shallow: bool) -> None:
+        depth = ["--depth", "1", "--single-branch"] if shallow else []
 
-        self._logger.info("Parsing resulting outputs of snakemake workflow")
-        self._results = {
-            y: pd.read_csv(target_dir / "outputs" / f"costs_{y}.csv") for y in self._list_results(target_dir, "costs")
-        }
+        # Ask git directly, which also covers existing directories that are not (or are nested inside of another) repo.
+        probe = subprocess.run(
+            ["git", "-C", target_dir, "rev-parse", "--show-toplevel"], capture_output=True, text=True
+        )
+        is_repo = probe.returncode == 0 and Path(probe.stdout.strip()).resolve() == Path(target_dir).resolve()
 
-    def _clone_repository(self, repo_url: str, target_dir: str, version: str) -> None:
-        if not os.path.exists(target_dir):
+        if not is_repo:
+            # `git clone` only works on empty (or missing) directories; fail early instead of with a cryptic git error.
+            if os.path.isdir(target_dir) and any(os.scandir(target_dir)):
+                raise FileExistsError(
+                    f"'{target_dir}' is not empty, and not a clone of 'technology-data'; use a new or empty 'target_dir'"
+                )
             self._logger.info("Cloning 'technology-data")
-            os.makedirs(target_dir)
+            os.makedirs(target_dir, exist_ok=True)
             if version == "latest":
-                subprocess.run(["git", "clone", repo_url, target_dir], check=True, capture_output=True, text=True)
+                subprocess.run(
+                    ["git", "clone", *depth, repo_url, target_dir],
+                    check=True,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.PIPE,
+                    text=True,
+                )
             else:
                 subprocess.run(
-                    ["git", "clone", repo_url, "--branch", version, target_dir],
+                    ["git", "clone", *depth, repo_url, "--branch", version, target_dir],
                     check=True,
-                    capture_output=True,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.PIPE,
                     text=True,
                 )
         else:
             self._logger.info("Updating 'technology-data'")
-            if version == "latest":
-                subprocess.run(["git", "-C", target_dir, "pull"], check=True, capture_output=True, text=True)
+            if shallow:
+                # A `pull` would need to re-hydrate the history; instead only fetch the requested commit and use it.
+                source = ["origin", "HEAD"] if version == "latest" else [repo_url, version]
+                subprocess.run(
+                    ["git", "-C", target_dir, "fetch", "--depth", "1", *source],
+                    check=True,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.PIPE,
+                    text=True,
+                )
+                revisions = subprocess.run(
+                    ["git", "-C", target_dir, "rev-parse", "HEAD", "FETCH_HEAD"],
+                    check=True,
+                    capture_output=True,
+                    text=True,
+                ).stdout.split()
+                # Only reset on actual changes, which would otherwise discard the outputs of previous runs; a `checkout`
+                # on the other hand fails as soon as previous runs modified tracked outputs.
+                if revisions[0] != revisions[1]:
+                    subprocess.run(
+                        ["git", "-C", target_dir, "reset", "--hard", "FETCH_HEAD"],
+                        check=True,
+                        stdout=subprocess.DEVNULL,
+                        stderr=subprocess.PIPE,
+                        text=True,
+                    )
+            elif version == "latest":
+                subprocess.run(
+                    ["git", "-C", target_dir, "pull"],
+                    check=True,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.PIPE,
+                    text=True,
+                )
             else:
                 subprocess.run(
-                    ["git", "-C", target_dir, "pull", repo_url, version], check=True, capture_output=True, text=True
+                    ["git", "-C", target_dir, "pull", repo_url, version],
+                    check=True,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.PIPE,
+                    text=True,
                 )
 
-    def _run_snakemake(self, target_dir: Path) -> None:
+    def _run_snakemake(self, target_dir: Path) -> bool:
         self._logger.info("Starting snakemake workflow")
-        current_working_directory = os.getcwd()
 
-        os.chdir(target_dir)
-        self._snakemake_output = subprocess.run(
-            ["snakemake", "-j1", "--configfile", "_emtd_config.yaml"], capture_output=True, text=True
-        )
-        os.chdir(current_working_directory)
+        # Pass absolute paths instead of changing the working directory, since the latter is global process state.
+        target_dir = target_dir.resolve()
+        args = [
+            "snakemake",
+            "--jobs",
+            str(self._jobs),
+            "--scheduler",
+            self._scheduler,
+            "--snakefile",
+            str(target_dir / "Snakefile"),
+            "--directory",
+            str(target_dir),
+            "--configfile",
+            str(target_dir / "_emtd_config.yaml"),
+        ]
+
+        # Stream the output to the logger, only keeping its tail (instead of buffering everything) for errors.
+        tail = deque(maxlen=200)
+        with subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1) as proc:
+            for line in proc.stdout:
+                self._logger.debug("Snakemake: %s", line.rstrip())
+                tail.append(line)
+        self._snakemake_output = subprocess.CompletedProcess(args, proc.returncode, "".join(tail))
 
         if self._snakemake_output.returncode != 0:
             self._logger.error("Snakemake workflow failed")
-            self._logger.error("Snakemake stdout: %s", self._snakemake_output.stdout)
-            self._logger.error("Snakemake stderr: %s", self._snakemake_output.stderr)
-        else:
-            self._logger.info("Snakemake workflow successful")
+            self._logger.error("Snakemake output (last %d lines): %s", len(tail), self._snakemake_output.stdout)
+            return False
+
+        self._logger.info("Snakemake workflow successful")
+        return True
+
+    def _config_hash(self, target_dir: Path) -> str:
+        revision = subprocess.run(
+            ["git", "-C", target_dir, "rev-parse", "HEAD"], check=True, capture_output=True, text=True
+        ).stdout.strip()
+        config = yaml.dump(self._config, Dumper=SafeDumper, sort_keys=True)
+        return hashlib.sha256((revision + config).encode()).hexdigest()
+
+    def _has_outputs(self, target_dir: Path) -> bool:
+        if not (target_dir / "outputs").is_dir():
+            return False
+        years = self._config.get("years") or self._list_results(target_dir, "costs")
+        return len(years) > 0 and all((target_dir / "outputs" / f"costs_{y}.csv").is_file() for y in years)
 
     def _list_results(self, target_dir: Path, prefix: str) -> list:
-        years = []
-        for filename in os.listdir(target_dir / "outputs"):
-            match = re.findall(rf"{prefix}_(\d{{4}}).csv", filename)
-            if match:
-                years.append(int(match[0]))
+        years = [
+            int(fn.stem[len(prefix) + 1 :])
+            for fn in (target_dir / "outputs").glob(f"{prefix}_[0-9][0-9][0-9][0-9].csv")
+        ]
         self._logger.info("Found a total of %d applicable output files", len(years))
         return years
+
+    def _read_results(self, target_dir: Path, prefix: str, year: int) -> pd.DataFrame:
+        fn_csv = target_dir / "outputs" / f"{prefix}_{year}.csv"
+        fn_parquet = fn_csv.with_suffix(".parquet")
+
+        # Re-use the already parsed file, if it was written after the output of the last snakemake run.
+        df = None
+        if fn_parquet.is_file() and fn_parquet.stat().st_mtime >= fn_csv.stat().st_mtime:
+            try:
+                df = pd.read_parquet(fn_parquet)
+            except (OSError, ValueError):
+                self._logger.warning("Could not read '%s'; parsing '%s' again", fn_parquet, fn_csv)
+
+        if df is None:
+            # Only keep the columns that are actually used, and store the (often repeated) strings as categories.
+            df = pd.read_csv(
+                fn_csv,
+                engine="pyarrow",
+                usecols=["technology", "parameter", "value", "unit", "source", "further description"],
+                dtype={
+                    "technology": "category",
+                    "parameter": "category",
+                    "unit": "category",
+                    "source": "category",
+                    "further description": "category",
+                },
+            )
+            df = df.set_index(["technology", "parameter"]).sort_index()
+            self._write_atomic(fn_parquet, df.to_parquet)
+
+        # Both return missing strings as `None`; keep the `NaN` that the default (C) parser returned before.
+        return df.fillna(float("nan"))
+
+    def _load_results(self, fn: Path) -> Optional[dict]:
+        if not fn.is_file():
+            return None
+        try:
+            with open(fn, "rb") as f:
+                results = pickle.load(f)
+            # Anything but entries per year is unexpected content; treat it like a broken file.
+            if all(isinstance(entries, dict) for entries in results.values()):
+                return results
+        except (
+            OSError,
+            pickle.UnpicklingError,
+            EOFError,
+            AttributeError,
+            ImportError,
+            IndexError,
+            TypeError,
+            ValueError,
+        ):
+            # Truncated (e.g. interrupted write), or created by an incompatible version of pandas.
+            pass
+
+        self._logger.warning("Could not load previously parsed outputs from '%s'; parsing them again", fn)
+        fn.unlink(missing_ok=True)
+        return None
+
+    def _dump_results(self, fn: str) -> None:
+        with open(fn, "wb") as f:
+            pickle.dump(self._entries, f, protocol=5)
+
+    def _write_atomic(self, fn: Path, write) -> None:
+        # Write to a temporary file next to `fn` first, so that an interrupted write never leaves a truncated file.
+        # Failing to persist something only slows down the next run, so this is logged instead of raised.
+        fn_tmp = None
+        try:
+            fd, fn_tmp = tempfile.mkstemp(dir=fn.parent, prefix=f".{fn.name}.", suffix=".tmp")
+            os.close(fd)
+            write(fn_tmp)
+            os.replace(fn_tmp, fn)
+            fn_tmp = None
+        except OSError as error:
+            self._logger.warning("Could not write '%s': %s", fn, error)
+        finally:
+            if fn_tmp is not None:
+                Path(fn_tmp).unlink(missing_ok=True)
+
+    def _share_categories(self, df: pd.DataFrame) -> None:
+        # Re-code onto the categories of previously loaded years, so that the entries of all years reference the same
+        # string objects, keeping each (repeated) string only once in memory. Categories are only ever appended to.
+        for column in ["unit", "source", "further description"]:
+            categories = self._categories.get(column)
+            if categories is None:
+                self._categories[column] = df[column].cat.categories
+                continue
+            new = df[column].cat.categories.difference(categories)
+            if len(new) > 0:
+                categories = self._categories[column] = categories.append(new)
+            df[column] = df[column].cat.set_categories(categories)
+
+    def _outputs_unchanged(self) -> bool:
+        if self._cfg_hash is None:
+            return True
+        try:
+            return (self._target_dir / "_emtd_cache_hash").read_text() == self._cfg_hash
+        except OSError:
+            return False
+
+    def _cached_technologies(self, year: int) -> dict:
+        # Maps each technology to its parameters, both as (ordered) dict keys to allow constant time membership checks.
+        technologies = self._technologies.get(year)
+        if technologies is None:
+            technologies = dict()
+            for tech, param in self._cached_entries(year):
+                technologies.setdefault(tech, dict())[param] = None
+            # Do not cache anything for years that could not be parsed.
+            if year in self._entries:
+                self._technologies[year] = technologies
+        return technologies
+
+    def _cached_parameters(self, year: int, tech: str) -> dict:
+        return self._cached_technologies(year).get(tech, dict())
+
+    def _cached_entries(self, year: int) -> dict:
+        # Plain dicts per (technology, parameter), so that `get` does not need to index into pandas at all. The parsed
+        # frame is only needed to build them, and dropped afterwards to not keep each year in memory twice.
+        entries = self._entries.get(year)
+        if entries is None:
+            # Never parse outputs that were re-built (or removed) by another instance, using a different config.
+            if not self._outputs_unchanged():
+                self._logger.error(
+                    "Outputs in '%s' changed since initialization; not parsing results for year %d",
+                    self._target_dir,
+                    year,
+                )
+                return dict()
+
+            self._logger.info("Parsing outputs of snakemake workflow for year %d", year)
+            try:
+                df = self._read_results(self._target_dir, "costs", year)
+            except OSError as error:
+                self._logger.error("Could not parse results for year %d: %s", year, error)
+                return dict()
+
+            if not self._outputs_unchanged():
+                self._logger.error(
+                    "Outputs in '%s' changed while parsing; discarding results for year %d", self._target_dir, year
+                )
+                return dict()
+            self._share_categories(df)
+
+            columns = ["value", "unit", "source", "further description"]
+            entries = dict()
+            for key, *values in df[columns].itertuples(name=None):
+                # Ambiguous entries are marked using `None`.
+                entries[key] = None if key in entries else dict(zip(columns, values))
+            self._entries[year] = entries
+
+            # Persist the entries once all years were parsed, to skip parsing entirely the next time.
+            if self._fn_results is not None and self._entries.keys() == self._available_years:
+                self._write_atomic(self._fn_results, self._dump_results)
+        return entries